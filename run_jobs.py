@@ -1,9 +1,23 @@
+import asyncio
+import gzip
+import hashlib
 import os
 import time
 import uuid
-import requests
+import httpx
+import ijson
+import orjson
+from aiolimiter import AsyncLimiter
+from pybloom_live import ScalableBloomFilter
+from collections import defaultdict
 from datetime import datetime, timezone
-from dateutil.parser import isoparse
+from itertools import islice
+from urllib.parse import quote, urlencode
+
+try:
+    import uvloop  # libuv event loop — noticeably less scheduling overhead at high fanout
+except ImportError:
+    uvloop = None
 
 
 def env(name: str, default: str = "") -> str:
@@ -27,83 +41,323 @@ MAX_JOBS_PER_COMPANY = int(env("MAX_JOBS", "500"))
 INCLUDE_AI = env("INCLUDE_AI", "false").lower() == "true"
 INCLUDE_LINKEDIN = env("INCLUDE_LINKEDIN", "false").lower() == "true"
 
+# Rows per job_posts upsert POST (matches the 200-row chunking for mark_inactive)
+UPSERT_BATCH = int(env("UPSERT_BATCH", "100"))
+# In-flight upsert chunks per company, multiplexed over the HTTP/2 connection
+UPSERT_PARALLEL = int(env("UPSERT_PARALLEL", "8"))
+
+# How many companies are in flight at once
+CONCURRENCY = int(env("CONCURRENCY", "8"))
+
+# A fetch smaller than this fraction of the known-active set is treated as a
+# partial Apify result and skipped rather than diffed (0 disables the guard)
+MIN_FETCH_RATIO = float(env("MIN_FETCH_RATIO", "0.1"))
+
+# Opt-in server-side diffing via the reconcile_company_jobs SQL function
+# (see sql/reconcile_company_jobs.sql — must be installed in your database first)
+USE_RECONCILE_RPC = env("USE_RECONCILE_RPC", "false").lower() == "true"
+
+# Token-bucket limiters per upstream host (the Apify one replaced the old per-company sleep)
+APIFY_LIMITER = AsyncLimiter(float(env("APIFY_MAX_RPS", "1")), 1.0)
+SUPABASE_LIMITER = AsyncLimiter(float(env("SUPABASE_MAX_RPS", "20")), 1.0)
+
 HEADERS_SUPABASE = {
     "apikey": SUPABASE_SERVICE_KEY,
     "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
     "Content-Type": "application/json",
 }
+# Prefer variants built once — no per-request dict copy
+HEADERS_UPSERT = {**HEADERS_SUPABASE, "Prefer": "resolution=merge-duplicates,return=minimal"}
+HEADERS_SIGNALS = {**HEADERS_SUPABASE, "Prefer": "return=minimal"}
 
 
-def die(msg: str):
-    raise SystemExit(msg)
-
-
-def ensure_env():
-    missing = [k for k in ["APIFY_TOKEN", "SUPABASE_URL", "SUPABASE_SERVICE_KEY"] if not env(k)]
-    if missing:
-        die(f"Missing env vars: {', '.join(missing)}")
-
+# Active-ids cache between runs (the set barely changes run-to-run).
+# Default TTL covers the daily cron with slack; the workflow persists .cache/
+# via actions/cache so the file survives between runs without REDIS_URL
+ACTIVE_IDS_TTL = int(env("ACTIVE_IDS_TTL", "90000"))
+CACHE_FILE = os.path.join(".cache", "active_uids.json")
 
-def apify_run_sync_get_items(actor: str, actor_input: dict, timeout_s: int = 180) -> list:
-    url = f"https://api.apify.com/v2/acts/{actor}/run-sync-get-dataset-items"
-    params = {"token": APIFY_TOKEN, "timeout": str(timeout_s)}
 
-    r = requests.post(url, params=params, json=actor_input, timeout=timeout_s + 30)
+class ActiveIdsCache:
+    """
+    Per-company cache of active job ids, cache-first with Supabase fallback.
+    Uses Redis when REDIS_URL is set, else a JSON file under .cache/.
+    """
 
-    if not r.ok:
-        print("Apify call failed")
-        print("Status code:", r.status_code)
-        print("Actor:", actor)
-        print("Request URL:", r.url)
-        print("Input sent:", actor_input)
-        print("Response body:", r.text[:2000])
-        r.raise_for_status()
+    def __init__(self):
+        self._redis = None
+        redis_url = env("REDIS_URL")
+        if redis_url:
+            try:
+                import redis
+
+                self._redis = redis.Redis.from_url(redis_url)
+            except ImportError:
+                print("REDIS_URL set but redis package not installed; using file cache")
+        self._data: dict = {}
+        if self._redis is None and os.path.exists(CACHE_FILE):
+            try:
+                with open(CACHE_FILE, "rb") as f:
+                    self._data = orjson.loads(f.read())
+            except (OSError, ValueError):
+                self._data = {}
+
+    def get(self, company: str) -> set[str] | None:
+        key = f"active:{company}"
+        if self._redis is not None:
+            raw = self._redis.get(key)
+            return set(orjson.loads(raw)) if raw else None
+        entry = self._data.get(key)
+        if not entry or time.time() - entry.get("ts", 0) > ACTIVE_IDS_TTL:
+            return None
+        return set(entry["uids"])
+
+    def get_sig(self, company: str) -> str | None:
+        key = f"sig:{company}"
+        if self._redis is not None:
+            raw = self._redis.get(key)
+            return raw.decode() if raw else None
+        entry = self._data.get(key)
+        if not entry or time.time() - entry.get("ts", 0) > ACTIVE_IDS_TTL:
+            return None
+        return entry["sig"]
+
+    def put_sig(self, company: str, sig: str) -> None:
+        key = f"sig:{company}"
+        if self._redis is not None:
+            self._redis.set(key, sig, ex=ACTIVE_IDS_TTL)
+            return
+        self._data[key] = {"ts": time.time(), "sig": sig}
 
-    return r.json()
+    def put(self, company: str, ids: set[str]) -> None:
+        key = f"active:{company}"
+        if self._redis is not None:
+            self._redis.set(key, orjson.dumps(sorted(ids)), ex=ACTIVE_IDS_TTL)
+            return
+        self._data[key] = {"ts": time.time(), "uids": sorted(ids)}
 
+    def save(self) -> None:
+        if self._redis is not None:
+            return
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        with open(CACHE_FILE, "wb") as f:
+            f.write(orjson.dumps(self._data))
+
+
+class _StreamReader:
+    """Minimal async .read() adapter so ijson can consume an httpx byte stream."""
+
+    def __init__(self, aiter):
+        self._aiter = aiter
+        self._buf = b""
+
+    async def read(self, n: int = -1) -> bytes:
+        while n < 0 or len(self._buf) < n:
+            try:
+                self._buf += await self._aiter.__anext__()
+            except StopAsyncIteration:
+                break
+        if n < 0:
+            out, self._buf = self._buf, b""
+        else:
+            out, self._buf = self._buf[:n], self._buf[n:]
+        return out
+
+
+# statuses worth retrying — rate limits and transient upstream errors
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+
+
+async def request_with_retry(
+    client: httpx.AsyncClient, method: str, url: str, retries: int = 3, backoff: float = 0.3, **kwargs
+) -> httpx.Response:
+    """Issue a request on the shared client, retrying transient failures with backoff."""
+    limited = SUPABASE_URL and url.startswith(SUPABASE_URL)
+    for attempt in range(retries):
+        if limited:
+            await SUPABASE_LIMITER.acquire()
+        r = await client.request(method, url, **kwargs)
+        if r.status_code not in TRANSIENT_STATUSES:
+            return r
+        if attempt + 1 < retries:
+            delay = backoff * (2**attempt)
+            retry_after = r.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    delay = max(delay, float(retry_after))
+                except ValueError:
+                    pass
+            await asyncio.sleep(delay)
+    # out of attempts — hand the last transient response to the caller's
+    # error handling rather than firing an extra unthrottled request
+    return r
 
-def supabase_get_active_job_ids(company: str) -> set[str]:
-    url = f"{SUPABASE_URL}/rest/v1/job_posts"
-    params = {
-        "select": JOB_ID_COL,
-        "company": f"eq.{company}",
-        "is_active": "eq.true",
-        "limit": "10000",
-    }
 
-    r = requests.get(url, headers=HEADERS_SUPABASE, params=params, timeout=60)
+def die(msg: str):
+    raise SystemExit(msg)
 
-    if not r.ok:
-        print("Supabase GET failed")
-        print("Status code:", r.status_code)
-        print("Request URL:", r.url)
-        print("Response body:", r.text[:1000])
-        r.raise_for_status()
 
-    return {str(row[JOB_ID_COL]) for row in r.json()}
+def ensure_env():
+    # the module globals are already stripped — no need to re-read os.environ
+    present = {"APIFY_TOKEN": APIFY_TOKEN, "SUPABASE_URL": SUPABASE_URL, "SUPABASE_SERVICE_KEY": SUPABASE_SERVICE_KEY}
+    missing = [k for k, v in present.items() if not v]
+    if missing:
+        die(f"Missing env vars: {', '.join(missing)}")
 
 
-def supabase_upsert_job_posts(rows: list[dict]) -> list[dict]:
+async def apify_run_sync_get_items(
+    client: httpx.AsyncClient, actor: str, actor_input: dict, timeout_s: int = 180,
+    retries: int = 3, backoff: float = 0.3,
+):
+    """Yield dataset items one at a time instead of materializing the full list in RAM."""
+    url = f"https://api.apify.com/v2/acts/{actor}/run-sync-get-dataset-items"
+    params = {"token": APIFY_TOKEN, "timeout": str(timeout_s)}
+    body = orjson.dumps(actor_input)
+
+    # run-sync-get-dataset-items long-polls the actor run, so the read timeout is generous
+    timeout = httpx.Timeout(10, read=timeout_s + 30)
+
+    # same transient-retry contract as request_with_retry, adapted for a streamed
+    # response: drain + back off on 429/5xx and transport errors, reopen, and only
+    # start yielding once a non-transient response arrives. A retry after a
+    # mid-stream disconnect re-yields earlier items; the caller's dedupe absorbs that.
+    for attempt in range(retries):
+        last_attempt = attempt + 1 >= retries
+        await APIFY_LIMITER.acquire()
+        try:
+            async with client.stream(
+                "POST", url, params=params, content=body,
+                headers={"Content-Type": "application/json"}, timeout=timeout,
+            ) as r:
+                if r.status_code in TRANSIENT_STATUSES and not last_attempt:
+                    await r.aread()  # drain so the connection can be reused
+                    delay = backoff * (2**attempt)
+                    retry_after = r.headers.get("Retry-After")
+                    if retry_after:
+                        try:
+                            delay = max(delay, float(retry_after))
+                        except ValueError:
+                            pass
+                    await asyncio.sleep(delay)
+                    continue
+
+                if r.is_error:
+                    text = (await r.aread()).decode("utf-8", "replace")
+                    print("Apify call failed")
+                    print("Status code:", r.status_code)
+                    print("Actor:", actor)
+                    print("Request URL:", r.url)
+                    print("Input sent:", actor_input)
+                    print("Response body:", text[:2000])
+                    r.raise_for_status()
+
+                # ijson reads the byte stream incrementally — peak memory is one item, not the dataset
+                async for item in ijson.items(_StreamReader(r.aiter_bytes()), "item"):
+                    yield item
+                return
+        except httpx.TransportError as e:  # covers ConnectError, ReadTimeout, RemoteProtocolError, ...
+            if last_attempt:
+                raise
+            print(f"Apify transport error ({type(e).__name__}: {e}) — retrying")
+            await asyncio.sleep(backoff * (2**attempt))
+
+
+def _postgrest_url(table: str, params: dict[str, str]) -> str:
+    # encode the query string once up front; httpx sends a ready URL verbatim
+    return f"{SUPABASE_URL}/rest/v1/{table}?" + urlencode(params, quote_via=quote, safe=",().:")
+
+
+def _in_filter(values: list[str]) -> str:
+    # PostgREST in.() values need double-quoting (company names contain commas/parens)
+    quoted = ",".join('"' + v.replace("\\", "\\\\").replace('"', '\\"') + '"' for v in values)
+    return f"in.({quoted})"
+
+
+# Endpoints that never vary within a run, built once at import
+SIGNALS_URL = f"{SUPABASE_URL}/rest/v1/signals"
+UPSERT_URL = _postgrest_url("job_posts", {"on_conflict": JOB_ID_COL})  # ✅ upsert on PRIMARY KEY id
+
+
+async def supabase_get_active_job_ids_bulk(
+    client: httpx.AsyncClient, companies: list[str]
+) -> dict[str, set[str]]:
+    """One GET (paginated if huge) for every company's active job ids, grouped per company."""
+    company_filter = _in_filter(companies)
+    out: dict[str, set[str]] = defaultdict(set)
+    offset = 0
+    page = 10000
+    while True:
+        url = _postgrest_url(
+            "job_posts",
+            {
+                "select": f"company,{JOB_ID_COL}",
+                "company": company_filter,
+                "is_active": "eq.true",
+                # offset pagination needs a stable order — without it Postgres may
+                # shuffle rows between pages and silently drop ids past page one
+                "order": JOB_ID_COL,
+                "limit": str(page),
+                "offset": str(offset),
+            },
+        )
+
+        r = await request_with_retry(client, "GET", url, headers=HEADERS_SUPABASE)
+        if r.is_error:
+            print("Supabase GET failed")
+            print("Status code:", r.status_code)
+            print("Request URL:", r.url)
+            print("Response body:", r.text[:1000])
+            r.raise_for_status()
+
+        rows = orjson.loads(r.content)
+        for row in rows:
+            out[row["company"]].add(row[JOB_ID_COL])
+        if len(rows) < page:
+            return out
+        offset += page
+
+
+# Gzip request bodies above this size — job-post rows are highly repetitive
+# (same company, same timestamps, same keys) and shrink 5-10x; below the
+# threshold the CPU isn't worth it
+GZIP_MIN_BYTES = 4096
+
+
+def _maybe_gzip(body: bytes, headers: dict) -> tuple[bytes, dict]:
+    if len(body) < GZIP_MIN_BYTES:
+        return body, headers
+    return gzip.compress(body, compresslevel=3), {**headers, "Content-Encoding": "gzip"}
+
+
+async def supabase_upsert_job_posts(client: httpx.AsyncClient, rows: list[dict]) -> int:
+    """Upsert rows and return how many were sent (return=minimal skips the echo payload)."""
     if not rows:
-        return []
+        return 0
 
-    url = f"{SUPABASE_URL}/rest/v1/job_posts"
-    headers = dict(HEADERS_SUPABASE)
-    headers["Prefer"] = "resolution=merge-duplicates,return=representation"
+    # PostgREST tolerates concurrent merge-duplicates upserts on the same PK,
+    # so oversized batches are split and posted in parallel (bounded, so one
+    # giant company can't monopolize the connection)
+    if len(rows) > UPSERT_BATCH:
+        chunks = [rows[i : i + UPSERT_BATCH] for i in range(0, len(rows), UPSERT_BATCH)]
+        sem = asyncio.Semaphore(UPSERT_PARALLEL)
 
-    # ✅ upsert on PRIMARY KEY id
-    params = {"on_conflict": JOB_ID_COL}
+        async def _post(chunk: list[dict]) -> int:
+            async with sem:
+                return await supabase_upsert_job_posts(client, chunk)
 
-    r = requests.post(url, headers=headers, params=params, json=rows, timeout=120)
+        results = await asyncio.gather(*(_post(c) for c in chunks))
+        return sum(results)
 
-    if not r.ok:
+    body, headers = _maybe_gzip(orjson.dumps(rows), HEADERS_UPSERT)
+    r = await request_with_retry(client, "POST", UPSERT_URL, headers=headers, content=body)
+    if r.is_error:
         print("Supabase UPSERT failed")
         print("Status code:", r.status_code)
         print("Response body:", r.text[:2000])
         print("Example row keys:", sorted(list(rows[0].keys())) if rows else [])
         r.raise_for_status()
 
-    return r.json()
+    return len(rows)
 
 
 def _extract_missing_column_name(resp_text: str) -> str | None:
@@ -116,10 +370,18 @@ def _extract_missing_column_name(resp_text: str) -> str | None:
 
 
 def _prune_rows(rows: list[dict], drop_key: str) -> list[dict]:
-    return [{k: v for k, v in r.items() if k != drop_key} for r in rows]
+    # signal rows are built fresh for each insert, so pop in place instead of copying
+    for r in rows:
+        r.pop(drop_key, None)
+    return rows
 
 
-def supabase_insert_signals(rows: list[dict]) -> None:
+# Columns the signals table has already rejected this run — pre-drop them so
+# later inserts don't burn retries rediscovering the same schema mismatch
+_SIGNALS_DROPPED: set[str] = set()
+
+
+async def supabase_insert_signals(client: httpx.AsyncClient, rows: list[dict]) -> None:
     """
     Best-effort insert:
     - If your signals table is missing a column, drop it and retry.
@@ -128,20 +390,21 @@ def supabase_insert_signals(rows: list[dict]) -> None:
     if not rows:
         return
 
-    url = f"{SUPABASE_URL}/rest/v1/signals"
-    headers = dict(HEADERS_SUPABASE)
-    headers["Prefer"] = "return=minimal"
-
     working = rows
+    for col in _SIGNALS_DROPPED:
+        working = _prune_rows(working, col)
     for _ in range(10):
-        r = requests.post(url, headers=headers, json=working, timeout=120)
-        if r.ok:
+        # body can change between attempts (columns get dropped), so gzip per attempt
+        body, headers = _maybe_gzip(orjson.dumps(working), HEADERS_SIGNALS)
+        r = await request_with_retry(client, "POST", SIGNALS_URL, headers=headers, content=body)
+        if r.is_success:
             return
-
         text = r.text or ""
+
         missing_col = _extract_missing_column_name(text)
         if missing_col:
             print(f"Signal insert: dropping missing column '{missing_col}' and retrying...")
+            _SIGNALS_DROPPED.add(missing_col)
             working = _prune_rows(working, missing_col)
             continue
 
@@ -149,20 +412,99 @@ def supabase_insert_signals(rows: list[dict]) -> None:
         return
 
 
-def supabase_mark_inactive(company: str, job_ids: list[str]) -> None:
+# Run-level signal buffer: one big POST instead of one per company/chunk
+SIGNAL_FLUSH_THRESHOLD = 500
+_pending_signals: list[dict] = []
+
+
+async def queue_signals(client: httpx.AsyncClient, rows: list[dict]) -> None:
+    _pending_signals.extend(rows)
+    if len(_pending_signals) >= SIGNAL_FLUSH_THRESHOLD:
+        await flush_signals(client)
+
+
+async def flush_signals(client: httpx.AsyncClient) -> None:
+    global _pending_signals
+    # swap before the await so a concurrent flush can't double-send
+    rows, _pending_signals = _pending_signals, []
+    await supabase_insert_signals(client, rows)
+
+
+# Run-level mark-inactive buffer: ids accumulate per company and PATCH in chunks at
+# flush. 200 ids ≈ 7.4 KB of uuids in the request line — raising this past ~215 blows
+# the common 8 KB proxy request-line limit (414s on self-hosted Supabase)
+INACTIVE_FLUSH_BATCH = int(env("INACTIVE_FLUSH_BATCH", "200"))
+_pending_inactive: dict[str, list[str]] = defaultdict(list)
+
+
+def queue_inactive(company: str, job_ids: list[str]) -> None:
+    _pending_inactive[company].extend(job_ids)
+
+
+async def flush_inactive(client: httpx.AsyncClient, now_iso: str) -> None:
+    global _pending_inactive
+    pending, _pending_inactive = _pending_inactive, defaultdict(list)
+    for company, ids in pending.items():
+        # islice chunks off one iterator — no index math, no list re-slicing
+        it = iter(ids)
+        while chunk := list(islice(it, INACTIVE_FLUSH_BATCH)):
+            await supabase_mark_inactive(client, company, chunk, now_iso)
+
+
+async def supabase_mark_inactive(
+    client: httpx.AsyncClient, company: str, job_ids: list[str], now_iso: str
+) -> None:
     if not job_ids:
         return
-    url = f"{SUPABASE_URL}/rest/v1/job_posts"
     in_list = ",".join(job_ids)
-    params = {
-        "company": f"eq.{company}",
-        JOB_ID_COL: f"in.({in_list})",
-    }
+    url = _postgrest_url(
+        "job_posts",
+        {
+            "company": f"eq.{company}",
+            JOB_ID_COL: f"in.({in_list})",
+        },
+    )
     patch = {
         "is_active": False,
-        "last_seen_at": datetime.now(timezone.utc).isoformat(),
+        "last_seen_at": now_iso,
+    }
+    r = await request_with_retry(client, "PATCH", url, headers=HEADERS_SUPABASE, content=orjson.dumps(patch))
+    r.raise_for_status()
+
+
+async def supabase_reconcile_company_jobs(
+    client: httpx.AsyncClient, company: str, current_uids: list[str], now_iso: str
+) -> tuple[set[str], set[str]]:
+    """
+    One round-trip replacing GET-active + diff + mark_inactive + JOB_REMOVED inserts:
+    the SQL function does all of it atomically and returns (new_uids, removed_uids).
+    """
+    url = f"{SUPABASE_URL}/rest/v1/rpc/reconcile_company_jobs"
+    # p_min_ratio makes the SQL function enforce the partial-fetch guard —
+    # the client-side one can't fire in RPC mode (no active-ids prefetch)
+    payload = {
+        "p_company": company,
+        "p_current_uids": current_uids,
+        "p_now": now_iso,
+        "p_min_ratio": MIN_FETCH_RATIO,
     }
-    r = requests.patch(url, headers=HEADERS_SUPABASE, params=params, json=patch, timeout=120)
+    r = await request_with_retry(client, "POST", url, headers=HEADERS_SUPABASE, content=orjson.dumps(payload))
+    if r.is_error:
+        print("Supabase RPC reconcile_company_jobs failed")
+        print("Status code:", r.status_code)
+        print("Response body:", r.text[:1000])
+        r.raise_for_status()
+
+    data = orjson.loads(r.content)
+    row = data[0] if isinstance(data, list) else data
+    return set(row.get("new_uids") or []), set(row.get("removed_uids") or [])
+
+
+async def supabase_touch_last_seen(client: httpx.AsyncClient, company: str, now_iso: str) -> None:
+    """Bump last_seen_at on a company's active rows without re-upserting them."""
+    url = _postgrest_url("job_posts", {"company": f"eq.{company}", "is_active": "eq.true"})
+    patch = {"last_seen_at": now_iso}
+    r = await request_with_retry(client, "PATCH", url, headers=HEADERS_SUPABASE, content=orjson.dumps(patch))
     r.raise_for_status()
 
 
@@ -170,18 +512,61 @@ def safe_dt(s: str | None) -> str | None:
     if not s:
         return None
     try:
-        return isoparse(s).astimezone(timezone.utc).isoformat()
-    except Exception:
-        return None
+        # C-backed and handles RFC 3339 (incl. trailing Z) on 3.11+
+        if s.endswith("Z"):
+            s = s[:-1] + "+00:00"
+        return datetime.fromisoformat(s).astimezone(timezone.utc).isoformat()
+    except ValueError:
+        # rare non-RFC3339 shapes — fall back to dateutil when it's installed
+        try:
+            from dateutil.parser import isoparse
+
+            return isoparse(s).astimezone(timezone.utc).isoformat()
+        except Exception:
+            return None
+
+
+_UUID_NS = uuid.NAMESPACE_URL.bytes
+_sha1 = hashlib.sha1  # pre-bound — skips the module attr lookup per id
+
+
+def uuid5_str(seed: str) -> str:
+    """uuid.uuid5(NAMESPACE_URL, seed) without the UUID object allocation/reformat."""
+    # two update() calls instead of one ns+seed concat — no temporary bytes object
+    h = _sha1(_UUID_NS)
+    h.update(seed.encode("utf-8"))
+    b = bytearray(h.digest()[:16])
+    b[6] = (b[6] & 0x0F) | 0x50
+    b[8] = (b[8] & 0x3F) | 0x80
+    h = b.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def make_row_template(company: str, now_iso: str) -> dict:
+    """Constant row fields for one company — per-item rows are cheap copies of this."""
+    return {
+        "id": None,
+        "job_uid": None,  # ✅ NOT NULL in your DB
+        "company": company,
+        "title": None,
+        "location": None,
+        "country": None,
+        "first_seen_at": now_iso,
+        "last_seen_at": now_iso,
+        "is_active": True,
+        # optional columns you can add later if they exist:
+        # "posted_at": safe_dt(item.get("date_posted")),
+        # "source_url": job_url,
+    }
 
 
-def map_job_item_to_row(company: str, item: dict) -> dict:
+def map_job_item_to_row(company: str, item: dict, template: dict) -> dict:
     job_id = item.get("id")
     job_url = item.get("url") or ""
 
     # ✅ stable UUID across runs
     seed = f"{company}::{job_id or job_url}"
-    uid = str(uuid.uuid5(uuid.NAMESPACE_URL, seed))
+    uid = uuid5_str(seed)
 
     loc = None
     countries = item.get("countries_derived") or []
@@ -193,27 +578,20 @@ def map_job_item_to_row(company: str, item: dict) -> dict:
         parts = [p for p in [city, admin, country] if p]
         loc = ", ".join(parts) if parts else None
 
-    now = datetime.now(timezone.utc).isoformat()
-    return {
-        "id": uid,
-        "job_uid": uid,  # ✅ NOT NULL in your DB
-        "company": company,
-        "title": item.get("title") or "(no title)",
-        "location": loc,
-        "country": (countries[0] if countries else None),
-        "first_seen_at": now,
-        "last_seen_at": now,
-        "is_active": True,
-        # optional columns you can add later if they exist:
-        # "posted_at": safe_dt(item.get("date_posted")),
-        # "source_url": job_url,
-    }
+    row = template.copy()
+    row["id"] = uid
+    row["job_uid"] = uid
+    row["title"] = item.get("title") or "(no title)"
+    row["location"] = loc
+    row["country"] = countries[0] if countries else None
+    return row
 
 
-def build_new_job_signal(company: str, job_row: dict) -> dict:
+def build_new_job_signal(company: str, job_row: dict, now_iso: str) -> dict:
     title = job_row["title"]
     loc = job_row.get("location")
-    job_id = str(job_row.get("job_uid") or job_row[JOB_ID_COL])
+    # ids are already strings (uuid5_str), no coercion needed
+    job_id = job_row.get("job_uid") or job_row[JOB_ID_COL]
 
     return {
         # send multiple "likely" column names; missing ones get dropped automatically
@@ -222,7 +600,7 @@ def build_new_job_signal(company: str, job_row: dict) -> dict:
         "signal_type": "NEW_JOB",
         "type": "NEW_JOB",
         "title": f"{company} posted: {title}" + (f" ({loc})" if loc else ""),
-        "occurred_at": datetime.now(timezone.utc).isoformat(),
+        "occurred_at": now_iso,
         "strength_score": 40,
         "source_url": None,
         "metadata": {"job_id": job_id, "title": title, "location": loc},
@@ -230,15 +608,14 @@ def build_new_job_signal(company: str, job_row: dict) -> dict:
     }
 
 
-def build_removed_job_signal(company: str, job_id: str) -> dict:
-    job_id = str(job_id)
+def build_removed_job_signal(company: str, job_id: str, now_iso: str) -> dict:
     return {
         "account_name": company,
         "company": company,
         "signal_type": "JOB_REMOVED",
         "type": "JOB_REMOVED",
         "title": f"{company} job removed: {job_id}",
-        "occurred_at": datetime.now(timezone.utc).isoformat(),
+        "occurred_at": now_iso,
         "strength_score": 25,
         "source_url": None,
         "metadata": {"job_id": job_id},
@@ -246,12 +623,16 @@ def build_removed_job_signal(company: str, job_id: str) -> dict:
     }
 
 
-def load_companies() -> list[str]:
+def load_companies():
+    """Yield company names one at a time so workers can start before the file is fully read."""
     with open("companies.txt", "r", encoding="utf-8") as f:
-        return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
 
 
-def fetch_new_jobs_for_company(company: str) -> list[dict]:
+def fetch_new_jobs_for_company(client: httpx.AsyncClient, company: str):
     actor_input = {
         "organizationSearch": [company],  # ✅ MUST be array
         "timeRange": TIME_RANGE,
@@ -259,64 +640,229 @@ def fetch_new_jobs_for_company(company: str) -> list[dict]:
         "includeAi": INCLUDE_AI,
         "includeLinkedIn": INCLUDE_LINKEDIN,
     }
-    return apify_run_sync_get_items(CAREER_SITE_ACTOR, actor_input)
+    return apify_run_sync_get_items(client, CAREER_SITE_ACTOR, actor_input)
+
+
+async def process_company(
+    client: httpx.AsyncClient,
+    company: str,
+    existing_active: set[str],
+    cache: ActiveIdsCache,
+) -> tuple[int, int, int]:
+    """Full pipeline for one company. Returns (jobs_upserted, new_signals, removed_signals)."""
+    # one timestamp per company — every row/signal in the batch shares it
+    now_iso = datetime.now(timezone.utc).isoformat()
+    template = make_row_template(company, now_iso)
+
+    # buffer log lines so concurrent companies don't interleave output
+    log = [f"\n=== {company} ==="]
+    log.append(f"Existing active jobs: {len(existing_active)}")
+
+    # stream-parse items as they arrive (raw JSON is never fully buffered)
+    items_count = 0
+    row_keys: list[str] = []
+    mapped_by_uid: dict[str, dict] = {}
+    # probabilistic dedupe of repeated items within one response — KBs of memory,
+    # worst case a one-in-a-million legit row is dropped and re-ingested next run
+    seen = ScalableBloomFilter(initial_capacity=MAX_JOBS_PER_COMPANY * 2, error_rate=1e-6)
+    async for item in fetch_new_jobs_for_company(client, company):
+        dedup_key = str(item.get("id") or item.get("url") or "")
+        if dedup_key:
+            if dedup_key in seen:
+                continue
+            seen.add(dedup_key)
+        items_count += 1
+        row = map_job_item_to_row(company, item, template)
+        if not row_keys:
+            row_keys = sorted(row.keys())
+        # keyed by uid → the upsert payload is exactly deduped (first occurrence wins),
+        # catching id-vs-url aliases the Bloom pre-filter can't see
+        mapped_by_uid.setdefault(row[JOB_ID_COL], row)
+
+    log.append(f"Fetched items: {items_count}")
+    log.append(f"Row keys check: {row_keys}")
+
+    # a 0-item fetch is almost always an Apify transient, not a mass delisting —
+    # diffing it would mark every active job inactive and spray bogus JOB_REMOVED
+    # signals, so bail before touching Supabase (the stale cache entry survives)
+    if not mapped_by_uid:
+        log.append("0 items fetched — skipping (likely transient failure)")
+        print("\n".join(log))
+        return 0, 0, 0
+
+    # same reasoning for a suspiciously small fetch vs. what we know is active:
+    # more likely a truncated response than a real mass removal
+    if existing_active and len(mapped_by_uid) < MIN_FETCH_RATIO * len(existing_active):
+        log.append(
+            f"Suspiciously small fetch ({len(mapped_by_uid)} vs {len(existing_active)} active) — skipping diff"
+        )
+        print("\n".join(log))
+        return 0, 0, 0
+
+    # content signature of the fetched job set — when it matches the last run,
+    # skip the upsert/diff entirely and just bump last_seen_at (the common case)
+    sig = hashlib.blake2b(orjson.dumps(sorted(mapped_by_uid)), digest_size=16).hexdigest()
+    if mapped_by_uid and sig == cache.get_sig(company):
+        await supabase_touch_last_seen(client, company, now_iso)
+        cache.put(company, set(mapped_by_uid))
+        log.append("Unchanged since last run — bumped last_seen_at only")
+        print("\n".join(log))
+        return 0, 0, 0
+
+    # even on a signature-cache miss, today's fetch may equal what Supabase
+    # already has active — nothing added, nothing removed, so the per-row merge
+    # upsert is pure overhead; a single bulk PATCH bumps last_seen_at instead
+    # (keys == set compares as one C-level equality check)
+    if not USE_RECONCILE_RPC and mapped_by_uid.keys() == existing_active:
+        await supabase_touch_last_seen(client, company, now_iso)
+        cache.put(company, set(mapped_by_uid))
+        cache.put_sig(company, sig)
+        log.append("No membership change — bumped last_seen_at only")
+        print("\n".join(log))
+        return 0, 0, 0
+
+    # server-side diff: one RPC computes new/removed, marks removals inactive and
+    # inserts JOB_REMOVED signals inside Postgres (must run before the upsert
+    # flips every current row to is_active)
+    rpc_result = None
+    if USE_RECONCILE_RPC:
+        rpc_result = await supabase_reconcile_company_jobs(client, company, list(mapped_by_uid), now_iso)
+
+    upserted_count = await supabase_upsert_job_posts(client, list(mapped_by_uid.values()))
+    log.append(f"Upserted rows: {upserted_count}")
+
+    if rpc_result is not None:
+        new_uids = rpc_result[0] & mapped_by_uid.keys()
+        removed_count = len(rpc_result[1])
+    else:
+        # NEW jobs = in today's fetch but not previously active
+        # (dict_keys - set runs as one C-level set difference, no per-row bytecode)
+        new_uids = mapped_by_uid.keys() - existing_active
 
+    new_signals = [build_new_job_signal(company, mapped_by_uid[u], now_iso) for u in new_uids]
+    await queue_signals(client, new_signals)
+    log.append(f"NEW_JOB signals: {len(new_signals)}")
 
-def main():
-    ensure_env()
-    companies = load_companies()
-    now = datetime.now(timezone.utc).isoformat()
-    print(f"Run started: {now} | companies={len(companies)} | timeRange={TIME_RANGE}")
+    if rpc_result is None:
+        # REMOVED jobs (FREE diff method) = previously active but missing today
+        # (no sort — Supabase doesn't care about id order in in.() filters)
+        removed_ids = list(existing_active - mapped_by_uid.keys())
+        if removed_ids:
+            queue_inactive(company, removed_ids)
+            await queue_signals(client, [build_removed_job_signal(company, jid, now_iso) for jid in removed_ids])
+        removed_count = len(removed_ids)
+    log.append(f"JOB_REMOVED signals: {removed_count}")
 
-    total_new_signals = 0
-    total_removed_signals = 0
-    total_jobs_upserted = 0
+    # after the diff, exactly today's fetch is active — remember it for the next run
+    cache.put(company, set(mapped_by_uid))
+    cache.put_sig(company, sig)
 
-    for company in companies:
-        print(f"\n=== {company} ===")
+    print("\n".join(log))
+    return upserted_count, len(new_signals), removed_count
 
-        existing_active = supabase_get_active_job_ids(company)
-        print(f"Existing active jobs: {len(existing_active)}")
 
-        items = fetch_new_jobs_for_company(company)
-        print(f"Fetched items: {len(items)}")
+# Companies per bulk active-ids prefetch (keeps the in.() URL a sane size)
+PREFETCH_BATCH = 50
 
-        mapped_rows = [map_job_item_to_row(company, it) for it in items]
-        print("Row keys check:", sorted(mapped_rows[0].keys()) if mapped_rows else [])
 
-        upserted = supabase_upsert_job_posts(mapped_rows)
-        total_jobs_upserted += len(upserted)
-        print(f"Upserted rows: {len(upserted)}")
+async def _enqueue_batch(
+    queue: asyncio.Queue, client: httpx.AsyncClient, cache: ActiveIdsCache, batch: list[str]
+) -> None:
+    if USE_RECONCILE_RPC:
+        # the RPC diffs server-side, so skip the active-ids prefetch entirely
+        for c in batch:
+            await queue.put((c, set()))
+        return
 
-        # NEW jobs = in today's fetch but not previously active
-        current_ids = {str(r[JOB_ID_COL]) for r in mapped_rows}
-        new_rows = [r for r in mapped_rows if str(r[JOB_ID_COL]) not in existing_active]
-        new_signals = [build_new_job_signal(company, r) for r in new_rows]
-        supabase_insert_signals(new_signals)
-        total_new_signals += len(new_signals)
-        print(f"NEW_JOB signals: {len(new_signals)}")
+    # cache-first: only bulk-fetch active ids for companies with a stale/missing entry
+    active_map = {c: cache.get(c) for c in batch}
+    misses = [c for c, ids in active_map.items() if ids is None]
+    if misses:
+        active_map.update(await supabase_get_active_job_ids_bulk(client, misses))
+    print(f"Active-ids cache: {len(batch) - len(misses)} hits, {len(misses)} misses")
+    for c in batch:
+        await queue.put((c, active_map.get(c) or set()))
+
+
+async def produce_companies(
+    queue: asyncio.Queue, client: httpx.AsyncClient, cache: ActiveIdsCache
+) -> int:
+    """Stream companies.txt onto the queue in prefetch batches; returns companies produced."""
+    count = 0
+    batch: list[str] = []
+    for company in load_companies():
+        count += 1
+        batch.append(company)
+        if len(batch) >= PREFETCH_BATCH:
+            await _enqueue_batch(queue, client, cache, batch)
+            batch = []
+    if batch:
+        await _enqueue_batch(queue, client, cache, batch)
+    for _ in range(CONCURRENCY):
+        await queue.put(None)  # sentinel per worker
+    return count
+
+
+async def company_worker(
+    queue: asyncio.Queue, client: httpx.AsyncClient, cache: ActiveIdsCache
+) -> tuple[int, int, int, int]:
+    upserted = new = removed = failed = 0
+    while True:
+        job = await queue.get()
+        if job is None:
+            break
+        company, existing_active = job
+        try:
+            u, n, rm = await process_company(client, company, existing_active, cache)
+        except Exception as e:
+            # one bad company (Apify 4xx, schema drift, ...) must not cancel the
+            # whole gather and take the other workers down with it
+            print(f"\n=== {company} ===\nFAILED: {type(e).__name__}: {e}")
+            failed += 1
+            continue
+        upserted += u
+        new += n
+        removed += rm
+    return upserted, new, removed, failed
 
-        # REMOVED jobs (FREE diff method) = previously active but missing today
-        removed_ids = sorted(existing_active - current_ids)
-        if removed_ids:
-            BATCH = 200
-            for i in range(0, len(removed_ids), BATCH):
-                chunk = removed_ids[i : i + BATCH]
-                supabase_mark_inactive(company, chunk)
-                removed_signals = [build_removed_job_signal(company, jid) for jid in chunk]
-                supabase_insert_signals(removed_signals)
-                total_removed_signals += len(removed_signals)
-            print(f"JOB_REMOVED signals: {len(removed_ids)}")
-        else:
-            print("JOB_REMOVED signals: 0")
 
-        time.sleep(1.2)
+async def main():
+    ensure_env()
+    now = datetime.now(timezone.utc).isoformat()
+    print(f"Run started: {now} | timeRange={TIME_RANGE} | concurrency={CONCURRENCY}")
+
+    # HTTP/2 multiplexes the whole Supabase fanout over one warm TLS connection
+    limits = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+    timeout = httpx.Timeout(connect=10, read=120, write=60, pool=60)
+    cache = ActiveIdsCache()
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=timeout) as client:
+        # workers start on early companies while later lines are still being read
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * CONCURRENCY)
+        try:
+            companies_count, *worker_totals = await asyncio.gather(
+                produce_companies(queue, client, cache),
+                *(company_worker(queue, client, cache) for _ in range(CONCURRENCY)),
+            )
+        finally:
+            # the two drains touch different tables with no ordering dependency
+            await asyncio.gather(flush_inactive(client, now), flush_signals(client))
+            cache.save()
+
+    print(f"\nCompanies processed: {companies_count}")
+    total_jobs_upserted = sum(r[0] for r in worker_totals)
+    total_new_signals = sum(r[1] for r in worker_totals)
+    total_removed_signals = sum(r[2] for r in worker_totals)
+    total_failed = sum(r[3] for r in worker_totals)
 
     print("\n=== DONE ===")
     print(f"Total jobs upserted: {total_jobs_upserted}")
     print(f"Total NEW_JOB signals: {total_new_signals}")
     print(f"Total JOB_REMOVED signals: {total_removed_signals}")
+    if total_failed:
+        print(f"Companies failed: {total_failed}")
 
 
 if __name__ == "__main__":
-    main()
+    if uvloop is not None:
+        uvloop.install()
+    asyncio.run(main())
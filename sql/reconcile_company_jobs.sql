@@ -0,0 +1,67 @@
+-- Server-side diff for run_jobs.py (opt-in via USE_RECONCILE_RPC=true).
+--
+-- Replaces the client-side GET-active + diff + mark_inactive + JOB_REMOVED
+-- inserts with one atomic round-trip. Adjust the signals column list to match
+-- your actual signals schema before installing (the Python path auto-drops
+-- unknown columns; SQL cannot).
+
+create or replace function reconcile_company_jobs(
+  p_company text,
+  p_current_uids uuid[],
+  p_now timestamptz default now(),
+  p_min_ratio numeric default 0.1
+) returns table (new_uids uuid[], removed_uids uuid[])
+language plpgsql
+as $$
+declare
+  v_removed uuid[];
+  v_new uuid[];
+  v_active_count bigint;
+begin
+  -- partial-fetch guard (server-side twin of the client's MIN_FETCH_RATIO):
+  -- a uid set far below the company's active count is a truncated Apify
+  -- response, not a mass delisting — diffing it would false-inactivate the
+  -- company, so return an empty diff and change nothing
+  select count(*) into v_active_count
+    from job_posts
+   where company = p_company
+     and is_active;
+
+  if v_active_count > 0
+     and coalesce(array_length(p_current_uids, 1), 0) < p_min_ratio * v_active_count then
+    return query select '{}'::uuid[], '{}'::uuid[];
+    return;
+  end if;
+
+  -- previously active but missing from today's fetch
+  select coalesce(array_agg(id), '{}') into v_removed
+    from job_posts
+   where company = p_company
+     and is_active
+     and not (id = any(p_current_uids));
+
+  -- in today's fetch but not previously active (run BEFORE the client upsert)
+  select coalesce(array_agg(u.id), '{}') into v_new
+    from unnest(p_current_uids) as u(id)
+   where not exists (
+       select 1 from job_posts jp
+        where jp.id = u.id and jp.company = p_company and jp.is_active
+   );
+
+  update job_posts
+     set is_active = false, last_seen_at = p_now
+   where id = any(v_removed);
+
+  insert into signals (company, signal_type, title, occurred_at, strength_score, metadata, job_uid)
+  select p_company,
+         'JOB_REMOVED',
+         p_company || ' job removed: ' || r.id,
+         p_now,
+         25,
+         jsonb_build_object('job_id', r.id),
+         r.id
+    from unnest(v_removed) as r(id);
+
+  return query select v_new, v_removed;
+end;
+$$;